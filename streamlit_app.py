@@ -1,19 +1,179 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from collections import defaultdict, Counter
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import os
+from collections import deque
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import time
 import tempfile
 import io
+import csv
+
+# Contract-level columns kept from the first row seen for each contract
+CONTRACT_INFO_COLUMNS = {
+    'Buyer Name': 'buyer_name',
+    'Buyer ID': 'buyer_id',
+    'Vertical Name': 'vertical_name',
+    'Contract Status': 'contract_status',
+}
+
+# Explicit Arrow types for the main contracts file columns the app reads; other
+# columns are skipped and repetitive keys are dictionary-encoded
+MAIN_FILE_COLUMN_TYPES = {
+    'Zip Code': pa.string(),
+    'State ID': pa.string(),
+    'Contract Name': pa.dictionary(pa.int32(), pa.string()),
+    'Buyer Name': pa.dictionary(pa.int32(), pa.string()),
+    'Contract Status': pa.dictionary(pa.int32(), pa.string()),
+    'Buyer Status': pa.dictionary(pa.int32(), pa.string()),
+    'Buyer ID': pa.string(),
+    'Vertical Name': pa.string(),
+}
+
+# Fixed Arrow schema for per-batch zip state tables, so batches with different
+# numbers of contracts still concatenate
+ZIP_STATE_SCHEMA = pa.schema([
+    ('contract', pa.dictionary(pa.int32(), pa.string())),
+    ('zip', pa.string()),
+    ('state_id', pa.string()),
+])
+
+# Upper bound on worker processes used to load the main file
+MAX_LOAD_WORKERS = 8
+
+def process_chunk(chunk):
+    """Process a single chunk of data into contract-zip-state rows and contract info"""
+    # Add any missing optional columns as empty so every chunk has the same schema
+    missing_columns = [column for column in [*CONTRACT_INFO_COLUMNS, 'State ID'] if column not in chunk.columns]
+    chunk = chunk.reindex(columns=[*chunk.columns, *missing_columns], fill_value='')
+    
+    # Normalize zip codes once for the whole chunk and skip invalid ones
+    chunk = chunk.assign(zip=chunk['Zip Code'].astype(str).str.strip())
+    chunk = chunk[chunk['zip'].ne('') & chunk['zip'].ne('nan')]
+    chunk = chunk.assign(state_id=chunk['State ID'].fillna('').astype(str).str.strip())
+    
+    # Store contract info (only first occurrence)
+    first_rows = chunk.drop_duplicates('Contract Name', keep='first').set_index('Contract Name')
+    first_rows = first_rows[list(CONTRACT_INFO_COLUMNS)]
+    contract_info = first_rows.rename(columns=CONTRACT_INFO_COLUMNS).to_dict('index')
+    
+    # Drop repeated (contract, zip) pairs, keeping the last row so its state wins
+    chunk = chunk.drop_duplicates(subset=['Contract Name', 'zip'], keep='last')
+    
+    zip_states = chunk[['Contract Name', 'zip', 'state_id']].rename(columns={'Contract Name': 'contract'})
+    return zip_states, contract_info
+
+def load_worker_count():
+    """Number of load worker processes, limited to the CPUs this process may run on"""
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on macOS or Windows
+        available = os.cpu_count() or 1
+    return min(available, MAX_LOAD_WORKERS)
+
+def process_batch(batch, filter_active):
+    """Filter and process one Arrow record batch; runs in a worker process"""
+    chunk = batch.to_pandas()
+    total_rows = len(chunk)
+    
+    # Filter active contracts and buyers if specified
+    if filter_active:
+        if 'Contract Status' in chunk.columns:
+            chunk = chunk[chunk['Contract Status'].str.lower() == 'active']
+        if 'Buyer Status' in chunk.columns:
+            chunk = chunk[chunk['Buyer Status'].str.lower() == 'active']
+    
+    # Remove rows with missing contract name or zip code
+    chunk = chunk.dropna(subset=['Contract Name', 'Zip Code'])
+    active_rows = len(chunk)
+    
+    if chunk.empty:
+        return None, {}, total_rows, active_rows
+    
+    zip_states, contract_info = process_chunk(chunk)
+    zip_state_table = pa.Table.from_pandas(zip_states, schema=ZIP_STATE_SCHEMA, preserve_index=False)
+    return zip_state_table, contract_info, total_rows, active_rows
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def process_all_chunks(raw_bytes, chunk_size, filter_active):
+    """Read and process the main contracts file into edges, zip states and contract info"""
+    total_rows = 0
+    active_rows = 0
+    chunk_count = 0
+    zip_state_tables = []
+    contract_info = {}
+    
+    def collect(result):
+        nonlocal total_rows, active_rows
+        zip_state_table, chunk_info, chunk_rows, chunk_active_rows = result
+        total_rows += chunk_rows
+        active_rows += chunk_active_rows
+        if zip_state_table is not None:
+            zip_state_tables.append(zip_state_table)
+        # Keep contract info from the first chunk a contract appears in
+        for contract, info in chunk_info.items():
+            contract_info.setdefault(contract, info)
+    
+    # Read only the header line so column types can be keyed by the cleaned names
+    header_line = raw_bytes.split(b'\n', 1)[0].decode('utf-8-sig')
+    column_names = [name.strip() for name in next(csv.reader([header_line]))]
+    
+    # Stream CSV in Arrow record batches
+    read_options = pacsv.ReadOptions(block_size=chunk_size * 256, column_names=column_names, skip_rows=1)
+    include_columns = [name for name in column_names if name in MAIN_FILE_COLUMN_TYPES]
+    convert_options = pacsv.ConvertOptions(
+        column_types=MAIN_FILE_COLUMN_TYPES, include_columns=include_columns, strings_can_be_null=True
+    )
+    reader = pacsv.open_csv(io.BytesIO(raw_bytes), read_options=read_options, convert_options=convert_options)
+    
+    batches = iter(reader)
+    first_batches = list(itertools.islice(batches, 2))
+    if len(first_batches) < 2:
+        # A file that fits in one batch is processed inline without starting a pool
+        for batch in first_batches:
+            chunk_count += 1
+            collect(process_batch(batch, filter_active))
+    else:
+        # Process batches across the available CPUs, collecting results in file
+        # order and keeping a bounded number of batches in flight
+        max_workers = load_worker_count()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for batch in itertools.chain(first_batches, batches):
+                chunk_count += 1
+                pending.append(executor.submit(process_batch, batch, filter_active))
+                if len(pending) >= 2 * max_workers:
+                    collect(pending.popleft().result())
+            while pending:
+                collect(pending.popleft().result())
+    
+    # Combine chunk rows into one (contract, zip, state) table with categorical keys,
+    # using sorted categories so code order matches name order; the last state seen
+    # for a pair wins. Rows are sorted by contract once so later groupbys walk
+    # contiguous blocks
+    zip_state_df = pd.DataFrame(columns=['contract', 'zip', 'state_id'])
+    if zip_state_tables:
+        zip_state_df = pa.concat_tables(zip_state_tables).to_pandas()
+        zip_state_df = zip_state_df.drop_duplicates(['contract', 'zip'], keep='last', ignore_index=True)
+        for column in ('contract', 'zip'):
+            values = zip_state_df[column].astype('category').cat.remove_unused_categories()
+            zip_state_df[column] = values.cat.reorder_categories(sorted(values.cat.categories))
+        zip_state_df = zip_state_df.sort_values(['contract', 'zip'], ignore_index=True)
+    edges = zip_state_df[['contract', 'zip']]
+    
+    return edges, zip_state_df, contract_info, total_rows, active_rows, chunk_count
 
 class ContractZipAnalyzer:
     def __init__(self):
         # Initialize data storage in session state
-        if 'contract_zip_map' not in st.session_state:
-            st.session_state.contract_zip_map = defaultdict(set)
-            st.session_state.zip_contract_map = defaultdict(set)
+        if 'edges' not in st.session_state:
+            st.session_state.edges = pd.DataFrame(columns=['contract', 'zip'])
+            st.session_state.zip_state_df = pd.DataFrame(columns=['contract', 'zip', 'state_id'])
             st.session_state.contract_info = {}
             st.session_state.main_file_loaded = False
             st.session_state.logs = []
@@ -26,33 +186,25 @@ class ContractZipAnalyzer:
         st.session_state.logs.append(f"{timestamp} - {message}")
         st.write(f"{timestamp} - {message}")
     
-    def process_chunk(self, chunk):
-        """Process a single chunk of data"""
-        for _, row in chunk.iterrows():
-            contract = row['Contract Name']
-            zip_code = str(row['Zip Code']).strip()
-            state_id = str(row.get('State ID', '')).strip()
-            
-            # Skip invalid zip codes
-            if not zip_code or zip_code == 'nan':
-                continue
-                
-            # Store contract-zip mapping
-            st.session_state.contract_zip_map[contract].add(zip_code)
-            st.session_state.zip_contract_map[zip_code].add(contract)
-            
-            # Store contract info (only first occurrence)
-            if contract not in st.session_state.contract_info:
-                st.session_state.contract_info[contract] = {
-                    'buyer_name': row.get('Buyer Name', ''),
-                    'buyer_id': row.get('Buyer ID', ''),
-                    'vertical_name': row.get('Vertical Name', ''),
-                    'contract_status': row.get('Contract Status', ''),
-                    'zip_states': {}
-                }
-            
-            # Store state info for each zip
-            st.session_state.contract_info[contract]['zip_states'][zip_code] = state_id
+    def build_contract_info_df(self):
+        """Build a DataFrame of contract info indexed by contract name"""
+        return pd.DataFrame.from_dict(
+            st.session_state.contract_info, orient='index', columns=list(CONTRACT_INFO_COLUMNS.values())
+        ).rename(columns={key: column for column, key in CONTRACT_INFO_COLUMNS.items()})
+    
+    def build_active_counts_df(self, df, contract_column):
+        """Count distinct active contracts and buyers, lowercasing only the distinct statuses"""
+        contract_status = df['Contract Status'].astype('category')
+        status_levels = contract_status.cat.categories
+        active_mask = contract_status.isin(status_levels[status_levels.astype(str).str.lower() == 'active'])
+        active_df = df.loc[active_mask]
+        return pd.DataFrame({
+            'Metric': ['Active Contracts', 'Active Buyers'],
+            'Count': [
+                active_df[contract_column].nunique(dropna=False),
+                active_df['Buyer Name'].nunique(dropna=False)
+            ]
+        })
     
     def load_main_file(self, main_file, chunk_size, filter_active):
         """Load and process the main contracts file"""
@@ -60,47 +212,22 @@ class ContractZipAnalyzer:
             self.log_message("Starting to load main contracts file...")
             
             # Reset data structures
-            st.session_state.contract_zip_map.clear()
-            st.session_state.zip_contract_map.clear()
+            st.session_state.edges = pd.DataFrame(columns=['contract', 'zip'])
+            st.session_state.zip_state_df = pd.DataFrame(columns=['contract', 'zip', 'state_id'])
             st.session_state.contract_info.clear()
             st.session_state.output_files.clear()
             
-            total_rows = 0
-            active_rows = 0
-            chunk_count = 0
+            # Parse the file (cached on its contents and load options)
+            edges, zip_state_df, contract_info, total_rows, active_rows, chunk_count = process_all_chunks(
+                main_file.getvalue(), chunk_size, filter_active
+            )
+            st.session_state.edges = edges
+            st.session_state.zip_state_df = zip_state_df
+            st.session_state.contract_info = contract_info
+            self.log_message(f"Processed {chunk_count} chunks")
             
-            # Read CSV from uploaded file
-            main_df = pd.read_csv(main_file, chunksize=chunk_size, low_memory=False)
-            
-            for chunk in main_df:
-                chunk_count += 1
-                total_rows += len(chunk)
-                
-                # Clean column names
-                chunk.columns = chunk.columns.str.strip()
-                
-                # Filter active contracts and buyers if specified
-                if filter_active:
-                    if 'Contract Status' in chunk.columns:
-                        chunk = chunk[chunk['Contract Status'].str.lower() == 'active']
-                    if 'Buyer Status' in chunk.columns:
-                        chunk = chunk[chunk['Buyer Status'].str.lower() == 'active']
-                
-                # Remove rows with missing contract name or zip code
-                chunk = chunk.dropna(subset=['Contract Name', 'Zip Code'])
-                active_rows += len(chunk)
-                
-                if chunk.empty:
-                    continue
-                
-                # Process chunk
-                self.process_chunk(chunk)
-                
-                if chunk_count % 10 == 0:
-                    self.log_message(f"Processed {chunk_count} chunks...")
-            
-            total_contracts = len(st.session_state.contract_zip_map)
-            total_zips = len(st.session_state.zip_contract_map)
+            total_contracts = st.session_state.edges['contract'].nunique()
+            total_zips = st.session_state.edges['zip'].nunique()
             
             self.log_message(f"Main file loaded successfully!")
             self.log_message(f"Total rows: {total_rows:,}, Active rows: {active_rows:,}")
@@ -109,6 +236,7 @@ class ContractZipAnalyzer:
             st.session_state.main_file_loaded = True
             
         except Exception as e:
+            st.session_state.main_file_loaded = False
             self.log_message(f"Error loading main file: {str(e)}")
             st.error(f"Failed to load main file: {str(e)}")
     
@@ -122,91 +250,72 @@ class ContractZipAnalyzer:
             
             # Generate contract summary
             self.log_message("Generating contract summary...")
-            summary_data = []
-            
-            for contract, zips in st.session_state.contract_zip_map.items():
-                info = st.session_state.contract_info[contract]
-                
-                # Count overlaps
-                overlap_count = 0
-                overlapping_contracts = set()
-                for zip_code in zips:
-                    other_contracts = st.session_state.zip_contract_map[zip_code] - {contract}
-                    overlap_count += len(other_contracts)
-                    overlapping_contracts.update(other_contracts)
-                
-                summary_data.append({
-                    'Contract Name': contract,
-                    'Buyer Name': info['buyer_name'],
-                    'Buyer ID': info['buyer_id'],
-                    'Vertical Name': info['vertical_name'],
-                    'Contract Status': info['contract_status'],
-                    'Total ZIP Codes': len(zips),
-                    'Total ZIP Matches': overlap_count,
-                    'Unique Contracts Overlapping': len(overlapping_contracts)
-                })
-            
-            summary_df = pd.DataFrame(summary_data).sort_values('Total ZIP Codes', ascending=False)
-            
-            # Generate active counts
-            active_counts = {
-                'Metric': ['Active Contracts', 'Active Buyers'],
-                'Count': [
-                    len(summary_df[summary_df['Contract Status'].str.lower() == 'active']),
-                    len(summary_df[summary_df['Contract Status'].str.lower() == 'active']['Buyer Name'].unique())
-                ]
-            }
-            active_counts_df = pd.DataFrame(active_counts)
+            edges = st.session_state.edges
+            info_df = self.build_contract_info_df()
+            
+            # Find overlaps once by joining the edges table with itself on zip;
+            # the summary and the detailed view both reuse this table
+            overlaps = edges.merge(edges, on='zip', suffixes=('', '_other'))
+            overlaps = overlaps[overlaps['contract'] != overlaps['contract_other']]
+            overlap_stats = overlaps.groupby('contract', sort=False, observed=True).agg(
+                total_matches=('contract_other', 'size'),
+                unique_overlap=('contract_other', 'nunique'),
+            )
+            contract_stats = pd.DataFrame({
+                'Total ZIP Codes': edges.groupby('contract', sort=False, observed=True).size(),
+                'Total ZIP Matches': overlap_stats['total_matches'],
+                'Unique Contracts Overlapping': overlap_stats['unique_overlap'],
+            }).fillna(0).astype(int)
+            
+            summary_df = info_df.join(contract_stats).rename_axis('Contract Name').reset_index()
+            summary_df = summary_df.sort_values('Total ZIP Codes', ascending=False)
+            
+            # Generate active counts once; both summary and detailed workbooks share them
+            active_counts_df = self.build_active_counts_df(summary_df, 'Contract Name')
             
             # Export contract summary and active counts
             summary_path = os.path.join(output_dir, "contract_summary.xlsx")
-            with pd.ExcelWriter(summary_path) as writer:
+            with pd.ExcelWriter(summary_path, engine='xlsxwriter') as writer:
                 summary_df.to_excel(writer, sheet_name="Contract Summary", index=False)
                 active_counts_df.to_excel(writer, sheet_name="Active Counts", index=False)
             self.log_message(f"Contract summary exported: {len(summary_df)} contracts")
-            self.log_message(f"Active counts: {active_counts['Count'][0]} contracts, {active_counts['Count'][1]} buyers")
+            self.log_message(f"Active counts: {active_counts_df['Count'][0]} contracts, {active_counts_df['Count'][1]} buyers")
             st.session_state.output_files['contract_summary.xlsx'] = summary_path
             
             # Generate detailed matches view
             self.log_message("Generating detailed matches view...")
-            detailed_data = []
             
-            for contract, zips in st.session_state.contract_zip_map.items():
-                contract_info = st.session_state.contract_info[contract]
-                
-                for zip_code in sorted(zips):
-                    other_contracts = st.session_state.zip_contract_map[zip_code] - {contract}
-                    match_string = ", ".join(sorted(other_contracts)) if other_contracts else ""
-                    state_id = contract_info['zip_states'].get(zip_code, '')
-                    
-                    detailed_data.append({
-                        'Contract Name': contract,
-                        'Buyer Name': contract_info['buyer_name'],
-                        'Buyer ID': contract_info['buyer_id'],
-                        'Vertical Name': contract_info['vertical_name'],
-                        'Contract Status': contract_info['contract_status'],
-                        'State ID': state_id,
-                        'Zip Code': zip_code,
-                        'MATCH': match_string
-                    })
-            
-            detailed_df = pd.DataFrame(detailed_data)
-            
-            # Generate contract match counts for detailed view
-            contract_match_counts = Counter()
-            for _, row in detailed_df.iterrows():
-                if row['MATCH']:
-                    matches = row['MATCH'].split(", ")
-                    contract_match_counts[row['Contract Name']] += len(matches)
-            
-            match_counts_df = pd.DataFrame.from_dict(
-                contract_match_counts, orient='index', columns=['Total ZIP Matches']
-            ).reset_index().rename(columns={'index': 'Contract Name'})
+            # One row per (contract, zip) with its state, already ordered by contract then zip
+            detailed_df = st.session_state.zip_state_df.rename(
+                columns={'contract': 'Contract Name', 'zip': 'Zip Code', 'state_id': 'State ID'}
+            )
+            
+            # Join every other contract sharing the zip into a sorted match string;
+            # sorting on category codes gives name order since categories are sorted
+            sorted_overlaps = overlaps.sort_values(['contract', 'zip', 'contract_other'])
+            match_strings = (
+                sorted_overlaps['contract_other'].astype(str)
+                .groupby([sorted_overlaps['contract'], sorted_overlaps['zip']], sort=False, observed=True)
+                .agg(', '.join)
+                .rename('MATCH')
+                .rename_axis(['Contract Name', 'Zip Code'])
+                .reset_index()
+            )
+            detailed_df = detailed_df.merge(match_strings, on=['Contract Name', 'Zip Code'], how='left')
+            detailed_df['MATCH'] = detailed_df['MATCH'].fillna('')
+            
+            # Attach contract info
+            detailed_df = detailed_df.merge(info_df, left_on='Contract Name', right_index=True, how='left')
+            detailed_df = detailed_df[['Contract Name', *CONTRACT_INFO_COLUMNS, 'State ID', 'Zip Code', 'MATCH']]
+            
+            # Generate contract match counts for detailed view from the overlap table
+            match_counts = overlap_stats['total_matches']
+            match_counts_df = match_counts.rename('Total ZIP Matches').rename_axis('Contract Name').reset_index()
             match_counts_df = match_counts_df.sort_values('Total ZIP Matches', ascending=False)
             
             # Export detailed matches, match counts, and active counts
             detailed_path = os.path.join(output_dir, "detailed_contract_zip_matches.xlsx")
-            with pd.ExcelWriter(detailed_path) as writer:
+            with pd.ExcelWriter(detailed_path, engine='xlsxwriter') as writer:
                 detailed_df.to_excel(writer, sheet_name="Detailed Matches", index=False)
                 match_counts_df.to_excel(writer, sheet_name="Contract Match Counts", index=False)
                 active_counts_df.to_excel(writer, sheet_name="Active Counts", index=False)
@@ -223,6 +332,9 @@ class ContractZipAnalyzer:
             self.log_message("Exporting individual contract sheets...")
             contracts_with_matches = summary_df[summary_df['Unique Contracts Overlapping'] > 0]['Contract Name'].tolist()
             
+            # Split detailed rows by contract in a single pass
+            contract_groups = dict(iter(detailed_df.groupby('Contract Name', sort=False, observed=True)))
+            
             # Split into multiple Excel files if too many contracts
             batch_size = 20
             for i in range(0, len(contracts_with_matches), batch_size):
@@ -230,20 +342,28 @@ class ContractZipAnalyzer:
                 batch_num = i // batch_size + 1
                 
                 batch_path = os.path.join(output_dir, f"contract_matches_batch_{batch_num}.xlsx")
-                with pd.ExcelWriter(batch_path) as writer:
+                with pd.ExcelWriter(batch_path, engine='xlsxwriter') as writer:
+                    used_sheet_names = set()
                     for contract in batch_contracts:
                         # Get all rows for this contract
-                        contract_data = detailed_df[detailed_df['Contract Name'] == contract]
+                        contract_data = contract_groups.get(contract)
                         
-                        if not contract_data.empty:
-                            # Clean sheet name
-                            sheet_name = contract.replace('/', '_').replace('\\', '_').replace('[', '').replace(']', '')[:31]
+                        if contract_data is not None and not contract_data.empty:
+                            # Clean sheet name, keeping it unique within the workbook
+                            clean_name = contract.replace('/', '_').replace('\\', '_').replace('[', '').replace(']', '')
+                            sheet_name = clean_name[:31]
+                            suffix = 1
+                            while sheet_name.lower() in used_sheet_names:
+                                suffix += 1
+                                sheet_name = f"{clean_name[:31 - len(str(suffix))]}{suffix}"
+                            used_sheet_names.add(sheet_name.lower())
                             contract_data.to_excel(writer, sheet_name=sheet_name, index=False)
                 
                 self.log_message(f"Exported batch {batch_num} with {len(batch_contracts)} contracts")
                 st.session_state.output_files[f"contract_matches_batch_{batch_num}.xlsx"] = batch_path
             
-            self.log_message(f"Exported {len(contracts_with_matches)} individual contract sheets in {batch_num} batch file(s)")
+            batch_count = (len(contracts_with_matches) + batch_size - 1) // batch_size
+            self.log_message(f"Exported {len(contracts_with_matches)} individual contract sheets in {batch_count} batch file(s)")
             self.log_message("Main analysis completed successfully!")
             
         except Exception as e:
@@ -256,7 +376,7 @@ class ContractZipAnalyzer:
             self.log_message("Loading new ZIP codes file...")
             
             # Load new ZIP codes file
-            new_zip_df = pd.read_csv(new_zip_file)
+            new_zip_df = pd.read_csv(new_zip_file, dtype=str)
             new_zip_df.columns = new_zip_df.columns.str.strip()
             
             # Expected columns: 'Zip Code' or 'ZIP Code', optionally 'State'
@@ -274,54 +394,35 @@ class ContractZipAnalyzer:
             # Analyze matches
             self.log_message("Matching new ZIP codes against active contracts...")
             
-            match_results = []
             new_zips = new_zip_df[zip_col].astype(str).str.strip().unique()
             
-            for zip_code in new_zips:
-                if zip_code in st.session_state.zip_contract_map:
-                    matching_contracts = st.session_state.zip_contract_map[zip_code]
-                    
-                    for contract in matching_contracts:
-                        contract_info = st.session_state.contract_info[contract]
-                        state_id = contract_info['zip_states'].get(zip_code, '')
-                        
-                        match_results.append({
-                            'New ZIP Code': zip_code,
-                            'State ID': state_id,
-                            'Matching Contract': contract,
-                            'Buyer Name': contract_info['buyer_name'],
-                            'Buyer ID': contract_info['buyer_id'],
-                            'Vertical Name': contract_info['vertical_name'],
-                            'Contract Status': contract_info['contract_status'],
-                            'Contract Total ZIP Codes': len(st.session_state.contract_zip_map[contract])
-                        })
-            
-            if match_results:
-                match_df = pd.DataFrame(match_results)
-                
-                # Generate contract match counts
-                contract_match_counts = Counter(match_df['Matching Contract'])
-                match_counts_df = pd.DataFrame.from_dict(
-                    contract_match_counts, orient='index', columns=['Total ZIP Matches']
-                ).reset_index().rename(columns={'index': 'Contract Name'})
-                match_counts_df = match_counts_df.sort_values('Total ZIP Matches', ascending=False)
+            # Join the new zips against the zip state table, then attach contract info
+            zip_state_df = st.session_state.zip_state_df.rename(
+                columns={'zip': 'New ZIP Code', 'contract': 'Matching Contract', 'state_id': 'State ID'}
+            )
+            match_df = pd.DataFrame({'New ZIP Code': new_zips}).merge(zip_state_df, on='New ZIP Code')
+            match_df = match_df.merge(self.build_contract_info_df(), left_on='Matching Contract', right_index=True)
+            contract_zip_counts = zip_state_df.groupby('Matching Contract', sort=False, observed=True).size()
+            match_df['Contract Total ZIP Codes'] = match_df['Matching Contract'].map(contract_zip_counts)
+            match_df = match_df[
+                ['New ZIP Code', 'State ID', 'Matching Contract', *CONTRACT_INFO_COLUMNS, 'Contract Total ZIP Codes']
+            ]
+            
+            if not match_df.empty:
+                # Generate contract match counts (value_counts sorts descending; unmatched
+                # contracts still appear as categories with a zero count)
+                match_counts = match_df['Matching Contract'].value_counts()
+                match_counts = match_counts[match_counts > 0]
+                match_counts_df = match_counts.rename_axis('Contract Name').reset_index(name='Total ZIP Matches')
                 
                 # Generate active counts
-                active_match_df = match_df[match_df['Contract Status'].str.lower() == 'active']
-                active_counts = {
-                    'Metric': ['Active Contracts', 'Active Buyers'],
-                    'Count': [
-                        len(active_match_df['Matching Contract'].unique()),
-                        len(active_match_df['Buyer Name'].unique())
-                    ]
-                }
-                active_counts_df = pd.DataFrame(active_counts)
+                active_counts_df = self.build_active_counts_df(match_df, 'Matching Contract')
                 
                 # Export matches, match counts, and active counts
                 output_dir = st.session_state.temp_dir
                 Path(output_dir).mkdir(exist_ok=True)
                 new_zip_path = os.path.join(output_dir, "new_zip_matches.xlsx")
-                with pd.ExcelWriter(new_zip_path) as writer:
+                with pd.ExcelWriter(new_zip_path, engine='xlsxwriter') as writer:
                     match_df.to_excel(writer, sheet_name="ZIP Matches", index=False)
                     match_counts_df.to_excel(writer, sheet_name="Contract Match Counts", index=False)
                     active_counts_df.to_excel(writer, sheet_name="Active Counts", index=False)
@@ -337,7 +438,7 @@ class ContractZipAnalyzer:
                 self.log_message(f"ZIP codes with matches: {matched_zips}")
                 self.log_message(f"Total matches found: {total_matches}")
                 self.log_message(f"Unique contracts matched: {unique_contracts}")
-                self.log_message(f"Active counts: {active_counts['Count'][0]} contracts, {active_counts['Count'][1]} buyers")
+                self.log_message(f"Active counts: {active_counts_df['Count'][0]} contracts, {active_counts_df['Count'][1]} buyers")
                 self.log_message(f"Results exported to: new_zip_matches.xlsx")
                 
                 # Log top 10 contracts by match count